@@ -1,13 +1,26 @@
 #!/usr/bin/env python3
 import os
+import calendar
 import json
-import re
-from datetime import datetime, timedelta
+import hashlib
+import sqlite3
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import lru_cache
 
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # ─── CONFIG ────────────────────────────────────────────────────────────────────
 EMBY_SERVER_URL    = os.environ['EMBY_SERVER_URL'].rstrip('/')
 EMBY_API_KEY       = os.environ['EMBY_API_KEY']
@@ -15,240 +28,599 @@ TELEGRAM_BOT_TOKEN = os.environ['TELEGRAM_BOT_TOKEN']
 TELEGRAM_CHAT_ID   = os.environ['TELEGRAM_CHAT_ID']
 TMDB_API_KEY       = os.environ['TMDB_API_KEY']
 TRAKT_API_KEY      = os.environ['TRAKT_API_KEY']
+DEBUG              = bool(os.environ.get('EMBY_NOTIFY_DEBUG'))
 
-CACHE_FILE    = 'data/cache.json'
+CACHE_FILE    = 'data/cache.json'   # formato legacy, solo per la migrazione
+STATE_FILE    = 'data/processed.sqlite'
+HTTP_CACHE    = 'data/http_cache.sqlite'
+TTL_TMDB      = 7 * 86400   # poster/trama cambiano di rado
+TTL_TRAKT     = 6 * 3600    # i voti si muovono più spesso
 HEADERS       = {'Accept': 'application/json'}
+TRAKT_HEADERS = {
+    'Content-Type': 'application/json',
+    'trakt-api-version': '2',
+    'trakt-api-key': TRAKT_API_KEY
+}
 TIMEOUT_EMBY  = (5, 30)
 TIMEOUT_OTHER = 10
+MAX_WORKERS   = int(os.environ.get('EMBY_NOTIFY_WORKERS', '8'))
+EMBY_PAGE     = 200
+TG_GROUP_MAX  = 10    # limite Telegram per sendMediaGroup
+TG_TEXT_MAX   = 4096  # limite Telegram per sendMessage
+TG_PHOTO_MAX  = 5_000_000   # limite Telegram per le foto inviate via URL
+TG_UPLOAD_MAX = 10_000_000  # limite Telegram per le foto caricate
+TG_RETRIES    = 5     # tentativi su 429 di Telegram
+# risposte di Telegram quando non riesce a scaricare la foto dall'URL
+TG_URL_ERRORS = ('failed to get HTTP URL', 'wrong file identifier/HTTP URL',
+                 'wrong type of the web page content')
+
+# ─── JSON ───────────────────────────────────────────────────────────────────────
+# orjson se disponibile (parse/serialize in C, bytes diretti), altrimenti stdlib
+
+def json_loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
 
 # ─── SESSION CON RETRY ───────────────────────────────────────────────────────────
 session = requests.Session()
 retries = Retry(
     total=5,
     backoff_factor=0.3,
-    status_forcelist=[500, 502, 503, 504],
-    allowed_methods=["GET", "POST"]
+    backoff_jitter=0.5,   # i thread in 429 non ritentano tutti allo stesso istante
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods=["GET", "POST"],
+    respect_retry_after_header=True
+)
+
+class TimeoutAdapter(HTTPAdapter):
+    # TIMEOUT_OTHER per ogni richiesta che non ne passa uno esplicito
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = TIMEOUT_OTHER
+        return super().send(request, **kwargs)
+
+# pochi host (Emby, TMDB, Trakt, Telegram) ma più richieste in parallelo
+# verso ciascuno: pool per host abbastanza grande da tenerle tutte vive
+adapter = TimeoutAdapter(
+    max_retries=retries, pool_connections=8, pool_maxsize=max(32, MAX_WORKERS),
+    pool_block=False
 )
-session.mount('http://', HTTPAdapter(max_retries=retries))
-session.mount('https://', HTTPAdapter(max_retries=retries))
+session.mount('http://', adapter)
+session.mount('https://', adapter)
+# Telegram: i 429 li gestisce telegram_post() con il retry_after del corpo
+# (passando dal limiter), quindi urllib3 non li ripete, nemmeno con
+# Retry-After. Niente replay dei POST su 5xx o timeout: il messaggio potrebbe
+# essere già arrivato e verrebbe inviato due volte; restano i retry di
+# connessione, quando la richiesta non è partita
+session.mount('https://api.telegram.org/', TimeoutAdapter(
+    max_retries=retries.new(
+        status_forcelist=[500, 502, 503, 504],
+        allowed_methods=["GET"],
+        respect_retry_after_header=False
+    ),
+    pool_connections=1, pool_maxsize=4, pool_block=False
+))
+session.headers.update(HEADERS)
+
+# ─── RATE LIMIT ──────────────────────────────────────────────────────────────────
+
+class RateLimiter:
+    # al massimo `calls` richieste ogni `period` secondi (finestra scorrevole),
+    # condiviso tra i thread del pool; i 429 residui li gestisce Retry
+    def __init__(self, calls, period):
+        self.calls  = calls
+        self.period = period
+        self.stamps = deque()
+        self.lock   = threading.Lock()
+
+    def acquire(self, cost=1):
+        # `cost` gettoni in una volta: un album Telegram sono più messaggi
+        cost = min(cost, self.calls)
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                while self.stamps and now - self.stamps[0] >= self.period:
+                    self.stamps.popleft()
+                excess = len(self.stamps) + cost - self.calls
+                if excess <= 0:
+                    self.stamps.extend([now] * cost)
+                    return self
+                time.sleep(self.period - (now - self.stamps[excess - 1]))
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc):
+        return False
+
+TMDB_LIMITER  = RateLimiter(40, 10)      # TMDB: ~40 req / 10s
+TRAKT_LIMITER = RateLimiter(1000, 300)   # Trakt: 1000 GET / 5min
+TELEGRAM_LIMITER = RateLimiter(20, 60)   # Telegram: 20 msg/min per gruppo
+
+# ─── CACHE HTTP ──────────────────────────────────────────────────────────────────
+# risposte JSON di TMDB/Trakt su SQLite, chiave = url + params ordinati,
+# corpo compresso con zlib (il JSON si riduce di 4-5x e il file è nel repo);
+# Emby e Telegram restano fuori (dati freschi / POST)
+
+_http_db   = None
+_http_lock = threading.Lock()
+
+def _http_cache():
+    global _http_db
+    if _http_db is None:
+        os.makedirs(os.path.dirname(HTTP_CACHE), exist_ok=True)
+        _http_db = sqlite3.connect(HTTP_CACHE, check_same_thread=False)
+        # un commit per ogni risposta scaricata: in WAL con synchronous=NORMAL
+        # non c'è un fsync a ognuno; close_http_cache() riporta tutto nel file
+        _http_db.execute('PRAGMA journal_mode=WAL')
+        _http_db.execute('PRAGMA synchronous=NORMAL')
+        with _http_db:
+            _http_db.execute(
+                'CREATE TABLE IF NOT EXISTS http_cache('
+                'key TEXT PRIMARY KEY, body BLOB, fetched_at INTEGER)'
+            )
+            _http_db.execute(
+                'DELETE FROM http_cache WHERE fetched_at < ?',
+                (int(time.time()) - max(TTL_TMDB, TTL_TRAKT),)
+            )
+    return _http_db
+
+def close_http_cache():
+    global _http_db
+    with _http_lock:
+        if _http_db is not None:
+            _http_db.close()
+            _http_db = None
+
+def _cache_key(url, params=None):
+    # api_key fuori dalla chiave: il file viene committato nel repo
+    key_params = sorted((k, str(v)) for k, v in (params or {}).items() if k != 'api_key')
+    return hashlib.sha1(json.dumps([url, key_params]).encode('utf-8')).hexdigest()
+
+def _cache_read(key, ttl):
+    # JSON della riga se più giovane di ttl, altrimenti None
+    with _http_lock:
+        row = _http_cache().execute(
+            'SELECT body, fetched_at FROM http_cache WHERE key = ?', (key,)
+        ).fetchone()
+    if row and int(time.time()) - row[1] < ttl:
+        try:
+            return json_loads(zlib.decompress(row[0]))
+        except (zlib.error, TypeError, ValueError):
+            pass   # riga illeggibile: la si riscarica e sovrascrive
+    return None
+
+def _cache_write(key, body):
+    with _http_lock:
+        db = _http_cache()
+        with db:
+            db.execute(
+                'INSERT OR REPLACE INTO http_cache VALUES (?, ?, ?)',
+                (key, zlib.compress(body), int(time.time()))
+            )
+
+def cached_get(url, params=None, headers=None, ttl=TTL_TMDB, limiter=TMDB_LIMITER):
+    key = _cache_key(url, params)
+    data = _cache_read(key, ttl)
+    if data is not None:
+        return data
+
+    with limiter:
+        r = session.get(url, params=params, headers=headers)
+    r.raise_for_status()
+    body = r.content
+    _cache_write(key, body)
+    return json_loads(body)
 
 # ─── HELPERS ────────────────────────────────────────────────────────────────────
 
+# kind interno -> segmenti di path delle API (Trakt: singolare, plurale)
+TMDB_KINDS  = {'movie': 'movie', 'series': 'tv'}
+TRAKT_KINDS = {'movie': ('movie', 'movies'), 'series': ('show', 'shows')}
+
+# errori attesi da TMDB/Trakt (rete, cache, JSON non valido, risposta senza i campi
+# attesi): il resto è un bug e deve emergere, non diventare un None muto
+API_ERRORS = (requests.RequestException, sqlite3.Error, ValueError, KeyError, IndexError, TypeError)
+
+# Markdown legacy di Telegram: dentro _corsivo_ non si può fare escape, un "_"
+# nel titolo chiude l'entità e va riaperta (_snake_\__case_); senza, il
+# messaggio viene respinto con 400 e con lui l'intero album
+_MD_ITALIC = str.maketrans({'_': '_\\__'})
+
+def md_italic(text):
+    return f"_{text.translate(_MD_ITALIC)}_"
+
+@lru_cache(maxsize=1024)
 def parse_emby_date(dt_str):
+    # epoch UTC in secondi interi: serve solo per il confronto col cutoff, per
+    # cui i decimali non contano e un int si confronta più in fretta di un
+    # datetime. Formato fisso di Emby, YYYY-MM-DDTHH:MM:SS[.fffffff]Z: slicing
+    # diretto in timegm; con un offset o altro dopo i secondi si passa da
+    # fromisoformat. Memoizzata: gli import in blocco producono molte
+    # DateCreated identiche
+    s = dt_str
+    tail = s[19:-1] if s[-1:] == 'Z' else s[19:]
+    if (len(s) >= 19 and s[4] == '-' and s[10] == 'T'
+            and (not tail or (tail[0] == '.' and tail[1:].isdigit()))):
+        return calendar.timegm((int(s[0:4]), int(s[5:7]), int(s[8:10]),
+                                int(s[11:13]), int(s[14:16]), int(s[17:19])))
     s = dt_str.rstrip('Z')
-    if '.' in s:
-        main, frac = s.split('.', 1)
-        frac = re.match(r'(\d{1,6})', frac).group(1)
-        s = f"{main}.{frac}"
-    return datetime.fromisoformat(s)
+    main, _, frac = s.partition('.')
+    if frac:
+        # Emby usa 7 decimali, fromisoformat (3.10) ne accetta 3 o 6;
+        # l'eventuale offset dopo i decimali resta
+        tz = frac.lstrip('0123456789')
+        digits = frac[:len(frac) - len(tz)]
+        s = f"{main}.{digits[:6].ljust(6, '0')}{tz}"
+    # le date senza offset sono UTC
+    return calendar.timegm(datetime.fromisoformat(s).utctimetuple())
 
-def get_movie_info_tmdb(title):
-    try:
-        r = session.get(
-            'https://api.themoviedb.org/3/search/movie',
-            params={'api_key': TMDB_API_KEY, 'query': title, 'language': 'it-IT'},
-            headers=HEADERS, timeout=TIMEOUT_OTHER
-        )
-        r.raise_for_status()
-        results = r.json().get('results', [])
-        if not results: return None, None
-        m = results[0]
-        d = session.get(
-            f"https://api.themoviedb.org/3/movie/{m['id']}",
-            params={'api_key': TMDB_API_KEY, 'language': 'it-IT'},
-            headers=HEADERS, timeout=TIMEOUT_OTHER
-        )
-        d.raise_for_status()
-        details = d.json()
-        over = details.get('overview','') or ''
-        if not over.strip():
-            e = session.get(
-                f"https://api.themoviedb.org/3/movie/{m['id']}",
-                params={'api_key': TMDB_API_KEY, 'language': 'en-US'},
-                headers=HEADERS, timeout=TIMEOUT_OTHER
-            )
-            e.raise_for_status()
-            over = e.json().get('overview','')
-        poster = details.get('poster_path')
-        if poster:
-            poster = f"https://image.tmdb.org/t/p/w500{poster}"
-        return poster, over
-    except Exception:
-        return None, None
+def _tmdb_details(kind, tmdb_id):
+    # una sola richiesta: le traduzioni arrivano insieme ai dettagli it-IT,
+    # così il fallback alla trama inglese non costa un altro round-trip
+    details = cached_get(
+        f"https://api.themoviedb.org/3/{kind}/{tmdb_id}",
+        {'api_key': TMDB_API_KEY, 'language': 'it-IT', 'append_to_response': 'translations'}
+    )
+    over = (details.get('overview','') or '').strip()
+    if not over:
+        en = [t for t in details.get('translations', {}).get('translations', [])
+              if t.get('iso_639_1') == 'en']
+        en.sort(key=lambda t: t.get('iso_3166_1') != 'US')
+        over = next((t['data']['overview'] for t in en if t.get('data', {}).get('overview')), '')
+    poster = details.get('poster_path')
+    if poster:
+        poster = f"https://image.tmdb.org/t/p/w500{poster}"
+    return poster, over
 
-def get_series_info_tmdb(title):
+def _poster_ok(url):
+    # Telegram rifiuta le foto via URL oltre i 5 MB (e un album intero fallisce
+    # per una sola foto): meglio il solo testo che un sendPhoto respinto.
+    # Si scarta il poster solo se la dimensione è nota e troppo grande: un
+    # errore o un HEAD non supportato (403/405 da CDN) lo lascia a Telegram.
+    # La dimensione va in cache accanto alle risposte TMDB: un HEAD per
+    # poster alla settimana invece che a ogni run
+    key = _cache_key(url, {'head': 'Content-Length'})
+    size = _cache_read(key, TTL_TMDB)
+    if size is None:
+        try:
+            r = session.head(url, timeout=5, allow_redirects=True)
+            size = int(r.headers.get('Content-Length', 0))
+        except (requests.RequestException, ValueError):
+            return True
+        if not r.ok:
+            return True
+        _cache_write(key, str(size).encode('ascii'))
+    return size < TG_PHOTO_MAX
+
+@lru_cache(maxsize=1024)
+def get_tmdb_info(title, kind='movie', tmdb_id=None):
+    tmdb_kind = TMDB_KINDS[kind]
     try:
-        r = session.get(
-            'https://api.themoviedb.org/3/search/tv',
-            params={'api_key': TMDB_API_KEY, 'query': title, 'language': 'it-IT'},
-            headers=HEADERS, timeout=TIMEOUT_OTHER
-        )
-        r.raise_for_status()
-        results = r.json().get('results', [])
-        if not results: return None, None
-        s = results[0]
-        d = session.get(
-            f"https://api.themoviedb.org/3/tv/{s['id']}",
-            params={'api_key': TMDB_API_KEY, 'language': 'it-IT'},
-            headers=HEADERS, timeout=TIMEOUT_OTHER
-        )
-        d.raise_for_status()
-        details = d.json()
-        over = details.get('overview','') or ''
-        if not over.strip():
-            e = session.get(
-                f"https://api.themoviedb.org/3/tv/{s['id']}",
-                params={'api_key': TMDB_API_KEY, 'language': 'en-US'},
-                headers=HEADERS, timeout=TIMEOUT_OTHER
-            )
-            e.raise_for_status()
-            over = e.json().get('overview','')
-        poster = details.get('poster_path')
-        if poster:
-            poster = f"https://image.tmdb.org/t/p/w500{poster}"
+        # con l'id TMDB già noto a Emby la ricerca per titolo non serve; se
+        # l'id è stantio o sbagliato (404) si ripiega comunque sul titolo
+        if tmdb_id:
+            try:
+                poster, over = _tmdb_details(tmdb_kind, tmdb_id)
+            except requests.HTTPError:
+                tmdb_id = None
+        if not tmdb_id:
+            results = cached_get(
+                f"https://api.themoviedb.org/3/search/{tmdb_kind}",
+                {'api_key': TMDB_API_KEY, 'query': title, 'language': 'it-IT'}
+            ).get('results', [])
+            if not results: return None, None
+            first = results[0]
+            over = (first.get('overview') or '').strip()
+            if over:
+                # la ricerca porta già poster e trama it-IT: i dettagli
+                # servono solo per il fallback alla trama inglese
+                poster = first.get('poster_path')
+                poster = f"https://image.tmdb.org/t/p/w500{poster}" if poster else None
+            else:
+                poster, over = _tmdb_details(tmdb_kind, first['id'])
+        if poster and not _poster_ok(poster):
+            poster = None
         return poster, over
-    except Exception:
+    except API_ERRORS:
         return None, None
 
-def get_trakt_rating(title, kind='movie'):
-    hdr = {
-        'Content-Type': 'application/json',
-        'trakt-api-version': '2',
-        'trakt-api-key': TRAKT_API_KEY
-    }
-    ep = 'movie' if kind == 'movie' else 'show'
+@lru_cache(maxsize=1024)
+def get_trakt_rating(title, kind='movie', tmdb_id=None):
+    ep, eps = TRAKT_KINDS[kind]
     try:
-        r = session.get(
-            f"https://api.trakt.tv/search/{ep}",
-            params={'query': title, 'limit': 1},
-            headers=hdr, timeout=TIMEOUT_OTHER
-        )
-        r.raise_for_status()
-        data = r.json()
+        data = None
+        # con l'id TMDB due titoli omonimi non condividono il voto
+        if tmdb_id:
+            data = cached_get(
+                f"https://api.trakt.tv/search/tmdb/{tmdb_id}",
+                {'type': ep},
+                headers=TRAKT_HEADERS, ttl=TTL_TRAKT, limiter=TRAKT_LIMITER
+            )
+        if not data:
+            data = cached_get(
+                f"https://api.trakt.tv/search/{ep}",
+                {'query': title, 'limit': 1},
+                headers=TRAKT_HEADERS, ttl=TTL_TRAKT, limiter=TRAKT_LIMITER
+            )
         if not data: return None
         slug = data[0][ep]['ids']['slug']
-        r2 = session.get(
-            f"https://api.trakt.tv/{ep}s/{slug}/ratings",
-            headers=hdr, timeout=TIMEOUT_OTHER
-        )
-        r2.raise_for_status()
-        rating = r2.json().get('rating')
+        rating = cached_get(
+            f"https://api.trakt.tv/{eps}/{slug}/ratings",
+            headers=TRAKT_HEADERS, ttl=TTL_TRAKT, limiter=TRAKT_LIMITER
+        ).get('rating')
         return round(rating,1) if rating is not None else None
-    except Exception:
+    except API_ERRORS:
         return None
 
+def telegram_post(method, cost=1, **kwargs):
+    # su 429 attende parameters.retry_after (o l'header Retry-After) e
+    # ripete la richiesta: la notifica non va persa. `cost` = messaggi che
+    # la richiesta produce nella chat (le foto di un album)
+    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/{method}"
+    for attempt in range(TG_RETRIES):
+        TELEGRAM_LIMITER.acquire(cost)
+        resp = session.post(url, **kwargs)
+        if resp.status_code != 429 or attempt == TG_RETRIES - 1:
+            break
+        wait = _retry_after(resp, attempt)
+        print(f"⏳ Telegram 429, nuovo tentativo tra {wait}s")
+        time.sleep(wait)
+    return resp
+
+def _retry_after(resp, attempt):
+    # secondi da attendere dopo un 429: prima il corpo JSON, poi l'header;
+    # un valore illeggibile (es. Retry-After come data HTTP) ripiega sul backoff
+    try:
+        return float(json_loads(resp.content)['parameters']['retry_after'])
+    except (ValueError, KeyError, TypeError):
+        pass
+    try:
+        return float(resp.headers['Retry-After'])
+    except (ValueError, KeyError, TypeError):
+        return float(2 ** attempt)
+
 def send_telegram(text, photo_url=None):
-    base = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/"
     payload = {'chat_id': TELEGRAM_CHAT_ID, 'parse_mode': 'Markdown'}
+    # il poster TMDB è pubblico: Telegram lo scarica da sé dall'URL
+    if photo_url:
+        method = 'sendPhoto'
+        payload.update({'photo': photo_url, 'caption': text})
+    else:
+        method = 'sendMessage'
+        payload['text'] = text
     try:
-        if photo_url:
-            data = payload.copy()
-            data.update({'caption': text})
-            resp = session.post(
-                base + 'sendPhoto',
-                params={'photo': photo_url},
-                data=data,
-                timeout=TIMEOUT_OTHER
-            )
-        else:
-            payload['text'] = text
-            resp = session.post(
-                base + 'sendMessage',
-                json=payload,
-                timeout=TIMEOUT_OTHER
+        resp = telegram_post(method, json=payload)
+        if photo_url and not resp.ok and any(e in resp.text for e in TG_URL_ERRORS):
+            # Telegram non raggiunge il poster: lo scarichiamo e lo carichiamo noi.
+            # Bytes e non img.raw: un 429 in telegram_post ripete l'upload, e
+            # requests legge comunque tutto il file per costruire il multipart.
+            # Letto a blocchi: oltre TG_UPLOAD_MAX si smette, con o senza
+            # Content-Length
+            data = bytearray()
+            with session.get(photo_url, stream=True) as img:
+                img.raise_for_status()
+                for block in img.iter_content(64 * 1024):
+                    data += block
+                    if len(data) > TG_UPLOAD_MAX:
+                        raise requests.RequestException(f"poster troppo grande: {photo_url}")
+            del payload['photo']
+            resp = telegram_post(
+                method, data=payload,
+                files={'photo': ('poster.jpg', bytes(data), 'image/jpeg')}
             )
         if not resp.ok:
             print("⚠️ Telegram error:", resp.text)
-    except Exception as e:
+    except requests.RequestException as e:
         print("⚠️ Telegram exception:", e)
 
-# ─── CACHE ──────────────────────────────────────────────────────────────────────
-
-def load_cache():
-    if os.path.exists(CACHE_FILE):
+def send_telegram_group(entries):
+    # entries = [(testo, poster_url)]: album da max TG_GROUP_MAX foto,
+    # una sola richiesta invece di una per notifica
+    for n in range(0, len(entries), TG_GROUP_MAX):
+        chunk = entries[n:n + TG_GROUP_MAX]
+        if len(chunk) == 1:
+            # sendMediaGroup vuole almeno 2 elementi
+            send_telegram(*chunk[0])
+            continue
+        media = [
+            {'type': 'photo', 'media': url, 'caption': text, 'parse_mode': 'Markdown'}
+            for text, url in chunk
+        ]
         try:
-            c = json.load(open(CACHE_FILE, encoding='utf-8'))
-            if isinstance(c, dict) and 'movie_ids' in c and 'episode_ids' in c:
-                return c
-        except Exception:
-            pass
-    return {'movie_ids': [], 'episode_ids': []}
-
-def save_cache(c):
-    os.makedirs(os.path.dirname(CACHE_FILE), exist_ok=True)
-    with open(CACHE_FILE, 'w', encoding='utf-8') as f:
-        json.dump(c, f, ensure_ascii=False, indent=2)
-
-# ─── MAIN ───────────────────────────────────────────────────────────────────────
-
-def process():
-    cache = load_cache()
-    old_movies   = set(cache['movie_ids'])
-    old_episodes = set(cache['episode_ids'])
+            resp = telegram_post(
+                'sendMediaGroup', cost=len(media),
+                json={'chat_id': TELEGRAM_CHAT_ID, 'media': media}
+            )
+            if not resp.ok:
+                # un poster irraggiungibile fa fallire l'intero album:
+                # si ripiega sugli invii singoli, ognuno col suo fallback
+                print("⚠️ Telegram error:", resp.text)
+                for text, url in chunk:
+                    send_telegram(text, url)
+        except requests.RequestException as e:
+            print("⚠️ Telegram exception:", e)
 
-    # cutoff 48h in UTC, con Z finale
-    cutoff_dt     = datetime.utcnow() - timedelta(hours=48)
-    cutoff_iso_z  = cutoff_dt.replace(microsecond=0).isoformat() + 'Z'
+def send_telegram_texts(texts):
+    # notifiche senza poster unite in un solo sendMessage, entro TG_TEXT_MAX
+    buf = ''
+    for t in texts:
+        if buf and len(buf) + 2 + len(t) > TG_TEXT_MAX:
+            send_telegram(buf)
+            buf = t
+        else:
+            buf = f"{buf}\n\n{t}" if buf else t
+    if buf:
+        send_telegram(buf)
 
-    # fetch solo items creati dopo cutoff
-    try:
+def fetch_emby_items(min_date_created):
+    # pagine da EMBY_PAGE item, restituite una alla volta: la risposta
+    # completa non sta mai in memoria tutta insieme
+    start = 0
+    while True:
         resp = session.get(
             f"{EMBY_SERVER_URL}/emby/Items",
             params={
                 'api_key': EMBY_API_KEY,
                 'IncludeItemTypes': 'Movie,Episode',
-                'Fields': 'DateCreated,Id,Name,SeriesName,ParentIndexNumber,IndexNumber,Path',
-                'MinDateCreated': cutoff_iso_z,
-                'Limit': 200
+                # Id, Name e Type arrivano sempre; Path non serve
+                'Fields': 'DateCreated,SeriesName,ParentIndexNumber,IndexNumber,ProviderIds',
+                'MinDateCreated': min_date_created,
+                # ordine stabile tra le pagine, notifiche in ordine cronologico
+                'SortBy': 'DateCreated',
+                'SortOrder': 'Ascending',
+                'EnableImages': 'false',
+                'EnableUserData': 'false',
+                'EnableTotalRecordCount': 'false',
+                'StartIndex': start,
+                'Limit': EMBY_PAGE
             },
-            headers=HEADERS,
             timeout=TIMEOUT_EMBY
         )
         resp.raise_for_status()
-        items = resp.json().get('Items', [])
-    except Exception as e:
+        if DEBUG:
+            print(f"Emby /Items StartIndex={start}: {len(resp.content)} byte")
+        page = json_loads(resp.content).get('Items', [])
+        yield from page
+        if len(page) < EMBY_PAGE:
+            return
+        start += EMBY_PAGE
+
+# ─── STATO ──────────────────────────────────────────────────────────────────────
+# id già notificati in SQLite: ogni run inserisce solo i nuovi (O(Δ)) invece
+# di riscrivere tutto il JSON, e un crash a metà non corrompe il file
+
+def open_state():
+    os.makedirs(os.path.dirname(STATE_FILE), exist_ok=True)
+    db = sqlite3.connect(STATE_FILE)
+    with db:
+        db.execute('CREATE TABLE IF NOT EXISTS seen(id TEXT PRIMARY KEY, ts INTEGER)')
+        if db.execute('SELECT 1 FROM seen LIMIT 1').fetchone() is None:
+            db.executemany(
+                'INSERT OR IGNORE INTO seen VALUES (?, 0)',
+                ((k,) for k in load_legacy_cache())
+            )
+    return db
+
+def load_legacy_cache():
+    # vecchio data/cache.json, importato alla prima apertura del db
+    if os.path.exists(CACHE_FILE):
+        try:
+            with open(CACHE_FILE, 'rb') as f:
+                c = json_loads(f.read())
+            return list(c.get('movie_ids', [])) + list(c.get('episode_ids', []))
+        except (OSError, ValueError, AttributeError):
+            pass
+    return []
+
+def is_processed(db, key):
+    return db.execute('SELECT 1 FROM seen WHERE id = ?', (key,)).fetchone() is not None
+
+def series_processed(db, series):
+    # chiavi "serie|id": range sulla primary key ('}' segue '|'), senza
+    # caricare né scandire tutta la tabella
+    return db.execute(
+        'SELECT 1 FROM seen WHERE id > ? AND id < ? LIMIT 1',
+        (series + '|', series + '}')
+    ).fetchone() is not None
+
+def save_processed(db, ids, ts):
+    # run senza novità: nessuna transazione, il file resta identico e il
+    # workflow non ha nulla da committare
+    if not ids:
+        return
+    with db:
+        db.executemany('INSERT OR IGNORE INTO seen VALUES (?, ?)', ((k, ts) for k in ids))
+
+# ─── MAIN ───────────────────────────────────────────────────────────────────────
+
+def process():
+    db = open_state()
+    # gli id già notificati restano nel db e si interrogano per chiave (indice
+    # della primary key): si materializza solo quanto visto in questo run
+    run_ids, run_series = set(), set()
+
+    # cutoff 48h come epoch UTC (come parse_emby_date) e in ISO con Z finale
+    cutoff_ts     = int(time.time()) - 48 * 3600
+    cutoff_iso_z  = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(cutoff_ts))
+
+    # (kind, titolo, id TMDB, testo, chiave) da arricchire con TMDB/Trakt e notificare
+    pending = []
+    try:
+        for i in fetch_emby_items(cutoff_iso_z):
+            try:
+                ts = parse_emby_date(i.get('DateCreated') or '')
+            except (ValueError, AttributeError):
+                continue
+            if ts < cutoff_ts:
+                continue
+
+            if i.get('Type') == 'Movie':
+                mid = i['Id']
+                if mid not in run_ids and not is_processed(db, mid):
+                    tmdb_id = (i.get('ProviderIds') or {}).get('Tmdb')
+                    pending.append(('movie', i['Name'], tmdb_id, f"*Nuovo film:* {md_italic(i['Name'])}", mid))
+                    run_ids.add(mid)
+
+            elif i.get('Type') == 'Episode':
+                series = i.get('SeriesName', 'Unknown')
+                season = i.get('ParentIndexNumber')
+                epnum  = i.get('IndexNumber')
+                # episodi salvati come "serie|id" per distinguerli
+                key = f"{series}|{i['Id']}"
+                if key not in run_ids and not is_processed(db, key):
+                    # controllo se è il primo episodio notificato di quella serie
+                    first = series not in run_series and not series_processed(db, series)
+                    tag = "Nuova Serie TV" if first else "Aggiornamento Serie TV"
+                    # ProviderIds dell'episodio non sono quelli della serie
+                    pending.append(('series', series, None, f"*{tag}:* {md_italic(series)}\nS{season}E{epnum}", key))
+                    run_ids.add(key)
+                    run_series.add(series)
+    except (requests.RequestException, ValueError) as e:
         print("⚠️ Errore Emby fetch:", e)
+        db.close()
         return
 
-    for i in items:
-        try:
-            dt = parse_emby_date(i['DateCreated'])
-        except Exception:
-            continue
-        if dt < cutoff_dt:
-            continue
+    # TMDB e Trakt in parallelo: il tempo totale è ~un RTT invece di N.
+    # I risultati si consumano in ordine mentre gli altri sono ancora in
+    # volo, così l'invio a Telegram si sovrappone ai fetch successivi
+    # ogni invio viene registrato subito nel db: se il run si interrompe a
+    # metà, il successivo non rimanda quanto già notificato
+    photos, photo_ids, texts, text_ids = [], [], [], []
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        # una sola lookup per titolo e id TMDB: gli episodi di una stessa
+        # serie condividono poster e voto, due film omonimi con id diversi no
+        lookups = {}
+        for kind, title, tmdb_id, _, _ in pending:
+            if (kind, title, tmdb_id) not in lookups:
+                lookups[(kind, title, tmdb_id)] = (
+                    pool.submit(get_tmdb_info, title, kind, tmdb_id),
+                    pool.submit(get_trakt_rating, title, kind, tmdb_id)
+                )
+        futures = [(txt, key, *lookups[(kind, title, tmdb_id)])
+                   for kind, title, tmdb_id, txt, key in pending]
+        for txt, key, f_info, f_rating in futures:
+            poster, plot = f_info.result()
+            rating = f_rating.result()
+            if rating: txt += f" (⭐ {rating}/10)"
+            if poster:
+                photos.append((txt, poster))
+                photo_ids.append(key)
+                if len(photos) == TG_GROUP_MAX:
+                    send_telegram_group(photos)
+                    save_processed(db, photo_ids, int(time.time()))
+                    photos, photo_ids = [], []
+            else:
+                texts.append(txt)
+                text_ids.append(key)
+    send_telegram_group(photos)
+    save_processed(db, photo_ids, int(time.time()))
+    send_telegram_texts(texts)
+    save_processed(db, text_ids, int(time.time()))
 
-        if i.get('Type') == 'Movie':
-            mid = i['Id']
-            if mid not in old_movies:
-                poster, plot = get_movie_info_tmdb(i['Name'])
-                rating = get_trakt_rating(i['Name'], 'movie')
-                txt = f"*Nuovo film:* _{i['Name']}_"
-                if rating: txt += f" (⭐ {rating}/10)"
-                send_telegram(txt, photo_url=poster)
-                old_movies.add(mid)
-
-        elif i.get('Type') == 'Episode':
-            eid    = i['Id']
-            series = i.get('SeriesName', 'Unknown')
-            season = i.get('ParentIndexNumber')
-            epnum  = i.get('IndexNumber')
-            if eid not in old_episodes:
-                poster, plot = get_series_info_tmdb(series)
-                rating = get_trakt_rating(series, 'series')
-                # controllo se è il primo episodio notificato di quella serie
-                first = not any(jsid for jsid in old_episodes if jsid.startswith(series + "|"))
-                tag = "Nuova Serie TV" if first else "Aggiornamento Serie TV"
-                txt = f"*{tag}:* _{series}_\nS{season}E{epnum}"
-                if rating: txt += f" (⭐ {rating}/10)"
-                send_telegram(txt, photo_url=poster)
-                # salvo in cache come "serie|id" per distinguerli
-                old_episodes.add(f"{series}|{eid}")
-
-    # aggiorno e salvo cache
-    cache['movie_ids']   = list(old_movies)
-    cache['episode_ids'] = list(old_episodes)
-    save_cache(cache)
+    db.close()
+    close_http_cache()
 
 if __name__ == '__main__':
     process()